@@ -1,26 +1,31 @@
 import os
-from flask import Flask, render_template, request, redirect, url_for, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, send_file, send_from_directory, jsonify, Response, stream_with_context, g, abort, current_app, session, make_response
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime # Removida a importação de timedelta
+from datetime import datetime, date # Removida a importação de timedelta
 from dotenv import load_dotenv
+import psycopg2
 import db
+import eventos
+import perfilador
+import click
 import json
 import csv
+import queue
+import threading
 from io import StringIO, BytesIO
+from collections import OrderedDict
+from markupsafe import Markup
+import hashlib
 
 load_dotenv()
 
-app = Flask(__name__)
-app.secret_key = os.getenv("SECRET_KEY", "chave_secreta_padrao_dev")
-
 # --- REMOVIDO: FILTRO JINJA2 PARA FORMATAR DATETIME ---
 # A formatação da data será feita no template usando o filtro 'format' padrão do Jinja2/Flask
 # e o objeto datetime original.
 
 # --- CONFIGURAÇÃO DE LOGIN ---
 login_manager = LoginManager()
-login_manager.init_app(app)
 login_manager.login_view = 'login' # Se tentar acessar página protegida, vai pra cá
 
 class User(UserMixin):
@@ -36,22 +41,160 @@ def load_user(user_id):
         return User(id=user_data['id'], username=user_data['username'], password_hash=user_data['password_hash'])
     return None
 
-# --- INICIALIZAÇÃO ---
-# Cria tabelas no Supabase se não existirem
-try:
+# --- REGISTRO DE ROTAS ---
+# As rotas são coletadas aqui e só entram no Flask dentro de create_app(),
+# mantendo os nomes de endpoint ('dashboard', 'ver_cliente'...) usados nos templates.
+ROTAS = []
+
+def rota(regra, **opcoes):
+    def decorador(funcao):
+        ROTAS.append((regra, funcao, opcoes))
+        return funcao
+    return decorador
+
+# --- INICIALIZAÇÃO DO BANCO ---
+# Nada de banco no import: o esquema é criado pelo comando "flask init-db" (uma vez por deploy)
+# ou, se INIT_DB_AUTOMATICO=1 (padrão), na primeira requisição de cada processo.
+
+def preparar_banco():
+    """Cria tabelas/triggers e o usuário admin padrão"""
     db.init_db()
-    
+
     # Cria usuário ADMIN padrão se não existir nenhum
     if not db.buscar_usuario_por_nome('admin'):
         print("Criando usuário admin padrão...")
         senha_hash = generate_password_hash('admin')
         db.criar_usuario('admin', senha_hash)
-except Exception as e:
-    print(f"Erro ao conectar no DB: {e}")
+
+_banco_pronto = False
+_banco_lock = threading.Lock()
+
+def garantir_banco():
+    """Roda uma vez por processo, antes da primeira requisição; tenta de novo se o DB falhar"""
+    global _banco_pronto
+    if _banco_pronto:
+        return
+    with _banco_lock:
+        if _banco_pronto:
+            return
+        try:
+            # Normalmente o deploy já rodou "flask init-db": só confere a versão do esquema
+            if db.esquema_pendente():
+                preparar_banco()
+            _banco_pronto = True
+        except Exception as e:
+            print(f"Erro ao conectar no DB: {e}")
+
+@click.command("init-db")
+def init_db_comando():
+    """Cria/atualiza as tabelas e o usuário admin padrão."""
+    preparar_banco()
+    click.echo("Banco inicializado.")
+
+# --- PERFIL DE DESEMPENHO (OPT-IN, SÓ ADMIN) ---
+# Ativado com ?_perfil=1 ou o header "X-Perfil: 1". A captura vai para perfilador.PERFIS_DIR
+# e o resumo DB/template/Python volta no header Server-Timing.
+ADMINS_PERFIL = [nome.strip() for nome in os.getenv("PERFIL_ADMINS", "admin").split(",") if nome.strip()]
+
+def _perfil_solicitado():
+    pedido = request.args.get('_perfil') == '1' or request.headers.get('X-Perfil') == '1'
+    return (pedido and request.endpoint not in ('eventos_ao_vivo', 'static')
+            and current_user.is_authenticated and current_user.username in ADMINS_PERFIL)
+
+def iniciar_perfil():
+    if _perfil_solicitado():
+        g.amostrador = perfilador.Amostrador().iniciar()
+
+def finalizar_perfil(response):
+    amostrador = g.pop('amostrador', None)
+    if amostrador:
+        amostrador.parar()
+        regra = request.url_rule.rule if request.url_rule else request.path
+        response.headers['Server-Timing'] = amostrador.server_timing()
+        response.headers['X-Perfil-Captura'] = perfilador.salvar_captura(amostrador, regra)
+    return response
+
+def descartar_perfil(erro=None):
+    # after_request não roda quando a view levanta exceção: sem isso a thread de amostragem fica viva
+    amostrador = g.pop('amostrador', None)
+    if amostrador:
+        amostrador.parar()
+
+@click.command("snapshots")
+def gerar_snapshots_comando():
+    """Grava os snapshots de saldo que faltam no log de auditoria."""
+    db.gerar_snapshots()
+    click.echo("Snapshots atualizados.")
+
+@click.command("perfis")
+@click.option('--rota', default=None, help="Filtra pela regra da rota, ex: /financeiro")
+@click.option('--saida', type=click.Path(), default=None, help="Arquivo .folded de saída (padrão: stdout)")
+def agregar_perfis(rota, saida):
+    """Soma as capturas de perfil em um único flamegraph (formato collapsed)."""
+    pilhas = perfilador.agregar_capturas(rota)
+    if not pilhas:
+        click.echo("Nenhuma captura encontrada.", err=True)
+        return
+
+    linhas = [f"{pilha} {contagem}" for pilha, contagem in pilhas.most_common()]
+    if saida:
+        with open(saida, 'w', encoding='utf-8') as arquivo:
+            arquivo.write("\n".join(linhas) + "\n")
+    else:
+        click.echo("\n".join(linhas))
+
+    total = sum(pilhas.values())
+    for categoria in perfilador.CATEGORIAS:
+        amostras = sum(c for p, c in pilhas.items() if p.split(';', 1)[0] == categoria)
+        click.echo(f"{categoria:>8}: {100 * amostras / total:5.1f}% ({amostras} amostras)", err=True)
+
+# --- CACHE HTTP (ETAG) E DE FRAGMENTOS ---
+# Cada escrita em db.py incrementa a versão das áreas afetadas (db.buscar_versoes).
+# Página cuja versão não mudou volta 304 e fragmento já renderizado é reaproveitado,
+# então uma visita repetida custa só a consulta das versões.
+VERSAO_APP = os.getenv("RENDER_GIT_COMMIT", "dev")  # deploy novo invalida tudo
+MAX_FRAGMENTOS = int(os.getenv("CACHE_FRAGMENTOS_MAX", "256"))
+
+_fragmentos = OrderedDict()
+_fragmentos_lock = threading.Lock()
+
+def em_cache(chave, gerar):
+    """Devolve o valor em cache para a chave (que deve conter as versões) ou gera e guarda"""
+    with _fragmentos_lock:
+        if chave in _fragmentos:
+            _fragmentos.move_to_end(chave)
+            return _fragmentos[chave]
+
+    valor = gerar()
+    with _fragmentos_lock:
+        _fragmentos[chave] = valor
+        while len(_fragmentos) > MAX_FRAGMENTOS:
+            _fragmentos.popitem(last=False)
+    return valor
+
+def fragmento(chave, gerar):
+    return em_cache(chave, lambda: Markup(gerar()))
+
+def responder_com_etag(chaves, renderizar, extra=''):
+    """Responde 304 se o navegador já tem a página desta versão dos dados; senão renderiza"""
+    versoes = db.buscar_versoes(chaves)
+    assinatura = f"{VERSAO_APP}|{current_user.get_id()}|{request.full_path}|{sorted(versoes.items())}|{extra}"
+    etag = hashlib.sha1(assinatura.encode('utf-8')).hexdigest()
+
+    # Mensagem flash pendente aparece no base.html: essa página não pode vir do cache
+    tem_flash = bool(session.get('_flashes'))
+    if not tem_flash and etag in request.if_none_match:
+        resposta = make_response('', 304)
+    else:
+        resposta = make_response(renderizar(versoes))
+    if not tem_flash:
+        resposta.set_etag(etag)
+    resposta.headers['Cache-Control'] = 'private, no-cache'
+    return resposta
 
 # --- ROTAS DE LOGIN ---
 
-@app.route('/login', methods=['GET', 'POST'])
+@rota('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
         return redirect(url_for('dashboard'))
@@ -71,7 +214,7 @@ def login():
             
     return render_template('login.html')
 
-@app.route('/logout')
+@rota('/logout')
 @login_required
 def logout():
     logout_user()
@@ -79,24 +222,96 @@ def logout():
 
 # --- ROTAS DA APLICAÇÃO (PROTEGIDAS) ---
 
-@app.route("/")
+@rota("/")
 @login_required
 def home():
     return redirect(url_for('dashboard'))
 
-@app.route("/dashboard")
+@rota("/dashboard")
 @login_required
 def dashboard():
     totals = db.get_dashboard_totals()
     return render_template("dashboard.html", totals=totals)
 
-@app.route("/clientes")
+@rota("/eventos")
+@login_required
+def eventos_ao_vivo():
+    """Stream SSE com os deltas de fiados, pagamentos, despesas e caixa"""
+    fila = eventos.transmissor.assinar()
+    if fila is None:
+        # Sem thread sobrando para mais um stream: o painel segue sem ao vivo e tenta depois
+        return Response("Limite de conexões ao vivo atingido", status=503,
+                        headers={'Retry-After': '60'})
+
+    def gerar():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    evento = fila.get(timeout=20)
+                except queue.Empty:
+                    yield ": ping\n\n"  # mantém a conexão viva atrás de proxies
+                    continue
+                yield eventos.formatar_sse(evento)
+                if evento.get('recarregar'):
+                    break
+        finally:
+            eventos.transmissor.cancelar(fila)
+
+    return Response(stream_with_context(gerar()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@rota("/api/sync", methods=['POST'])
+@login_required
+def api_sync():
+    """Recebe o lote de operações enfileiradas no balcão e devolve os deltas desde o cursor"""
+    corpo = request.get_json(silent=True) or {}
+    operacoes = corpo.get('operacoes') or []
+    if not isinstance(operacoes, list):
+        return jsonify({"erro": "'operacoes' deve ser uma lista"}), 400
+
+    try:
+        resposta = db.aplicar_lote_sync(operacoes, corpo.get('cursor'))
+    except ValueError as e:
+        # "chave" diz ao aparelho qual operação tirar da fila para o resto poder subir
+        return jsonify({"erro": str(e), "chave": getattr(e, 'chave', None)}), 400
+    except psycopg2.OperationalError as e:
+        # Conexão caiu ou deadlock que persistiu nas novas tentativas: a fila fica e tenta depois
+        print(f"Erro passageiro no sync: {e}")
+        return jsonify({"erro": "Servidor ocupado, tente de novo"}), 503, {'Retry-After': '5'}
+    return jsonify(resposta)
+
+@rota("/sw.js")
+def service_worker():
+    # Servido na raiz para o service worker poder controlar todas as páginas
+    resposta = send_from_directory(current_app.static_folder, 'sw.js', mimetype='application/javascript')
+    resposta.headers['Cache-Control'] = 'no-cache'
+    return resposta
+
+@rota("/admin/perfis")
+@login_required
+def listar_perfis():
+    if current_user.username not in ADMINS_PERFIL:
+        abort(403)
+    return jsonify(perfilador.listar_capturas(request.args.get('rota')))
+
+@rota("/admin/perfis/<nome>")
+@login_required
+def baixar_perfil(nome):
+    if current_user.username not in ADMINS_PERFIL:
+        abort(403)
+    return send_from_directory(perfilador.PERFIS_DIR, nome, as_attachment=True, mimetype='text/plain')
+
+@rota("/clientes")
 @login_required
 def clientes():
-    lista = db.buscar_clientes_com_divida()
-    return render_template("clientes.html", clientes=lista)
+    def renderizar(versoes):
+        lista_html = fragmento(('lista_clientes', versoes['clientes']),
+                               lambda: render_template("_lista_clientes.html", clientes=db.buscar_clientes_com_divida()))
+        return render_template("clientes.html", lista_html=lista_html)
+    return responder_com_etag(['clientes'], renderizar)
 
-@app.route("/cliente/novo", methods=['POST'])
+@rota("/cliente/novo", methods=['POST'])
 @login_required
 def novo_cliente():
     nome = request.form.get('nome')
@@ -113,7 +328,7 @@ def novo_cliente():
     flash('Cliente cadastrado!', 'success')
     return redirect(url_for('clientes'))
 
-@app.route("/fiado/registrar", methods=['GET', 'POST'])
+@rota("/fiado/registrar", methods=['GET', 'POST'])
 @login_required
 def registrar_fiado():
     if request.method == 'POST':
@@ -138,11 +353,13 @@ def registrar_fiado():
             flash("Selecione um cliente e insira um valor positivo.", "error")
             return redirect(url_for('registrar_fiado'))
 
-    clientes = db.buscar_clientes_com_divida()
-    return render_template("registrar_fiado.html", clientes=clientes)
+    def renderizar(versoes):
+        clientes = db.buscar_clientes_com_divida()
+        return render_template("registrar_fiado.html", clientes=clientes)
+    return responder_com_etag(['clientes'], renderizar)
 
 # --- Rota para Excluir Fiado Individualmente ---
-@app.route("/fiado/<int:fiado_id>/excluir", methods=['POST'])
+@rota("/fiado/<int:fiado_id>/excluir", methods=['POST'])
 @login_required
 def excluir_fiado(fiado_id):
     # Primeiro, pega o ID do cliente associado a este fiado para poder redirecionar
@@ -168,20 +385,42 @@ def excluir_fiado(fiado_id):
     return redirect(url_for('ver_cliente', cliente_id=cliente_id))
 
 
-@app.route("/cliente/<int:cliente_id>")
+@rota("/cliente/<int:cliente_id>")
 @login_required
 def ver_cliente(cliente_id):
+    def renderizar(versoes):
+        cliente = db.buscar_cliente(cliente_id)
+        itens = db.buscar_itens_pendentes(cliente_id)
+        pagamentos = db.buscar_ultimos_pagamentos(cliente_id)
+        total = db.get_saldo_cliente(cliente_id)
+
+        # --- REMOVIDO: AJUSTE DE FUSO HORÁRIO ---
+        # Os dados de data e hora serão passados como vieram do banco de dados (provavelmente UTC)
+
+        return render_template("cliente_detalhe.html", cliente=cliente, itens=itens, pagamentos=pagamentos, total=total)
+    return responder_com_etag([f'cliente:{cliente_id}'], renderizar)
+
+@rota("/cliente/<int:cliente_id>/historico")
+@login_required
+def historico_cliente(cliente_id):
+    """Saldo do cliente no fim de uma data e os eventos que o explicam"""
+    try:
+        dia = datetime.strptime(request.args.get('data', ''), '%Y-%m-%d').date()
+    except ValueError:
+        dia = date.today()
+    momento = datetime.combine(dia, datetime.max.time())
+
+    saldo = db.saldo_cliente_em(cliente_id, momento)
+    eventos_cliente = db.buscar_eventos_cliente(cliente_id, ate=momento)
+
+    # Cliente excluído: o nome continua no próprio log
     cliente = db.buscar_cliente(cliente_id)
-    itens = db.buscar_itens_pendentes(cliente_id)
-    pagamentos = db.buscar_ultimos_pagamentos(cliente_id)
-    total = db.get_saldo_cliente(cliente_id)
+    nome = cliente['nome'] if cliente else next((e['dados'].get('nome') for e in eventos_cliente if e['dados'].get('nome')), f"Cliente #{cliente_id}")
 
-    # --- REMOVIDO: AJUSTE DE FUSO HORÁRIO ---
-    # Os dados de data e hora serão passados como vieram do banco de dados (provavelmente UTC)
-    
-    return render_template("cliente_detalhe.html", cliente=cliente, itens=itens, pagamentos=pagamentos, total=total)
+    return render_template("cliente_historico.html", cliente_id=cliente_id, nome=nome, existe=bool(cliente),
+                           dia=dia, saldo=saldo, eventos=eventos_cliente)
 
-@app.route("/cliente/<int:cliente_id>/pagar", methods=['POST'])
+@rota("/cliente/<int:cliente_id>/pagar", methods=['POST'])
 @login_required
 def pagar_divida(cliente_id):
     valor = float(request.form.get('valor', 0))
@@ -190,25 +429,33 @@ def pagar_divida(cliente_id):
         flash('Pagamento registrado!', 'success')
     return redirect(url_for('ver_cliente', cliente_id=cliente_id))
 
-@app.route("/cliente/<int:cliente_id>/excluir", methods=['POST'])
+@rota("/cliente/<int:cliente_id>/excluir", methods=['POST'])
 @login_required
 def excluir_cliente(cliente_id):
     db.excluir_cliente_completo(cliente_id)
     flash('Cliente e histórico excluídos.', 'success')
     return redirect(url_for('clientes'))
 
-@app.route("/financeiro")
+@rota("/financeiro")
 @login_required
 def financeiro():
     agora = datetime.now()
     mes = int(request.args.get('mes', agora.month))
     ano = int(request.args.get('ano', agora.year))
-    relatorio = db.relatorio_mes(mes, ano)
-    historico = db.get_historico_anual()
     nomes_meses = {1:'Janeiro', 2:'Fevereiro', 3:'Março', 4:'Abril', 5:'Maio', 6:'Junho', 7:'Julho', 8:'Agosto', 9:'Setembro', 10:'Outubro', 11:'Novembro', 12:'Dezembro'}
-    return render_template("financeiro.html", relatorio=relatorio, historico=historico, mes_atual=mes, ano_atual=ano, nome_mes=nomes_meses.get(mes, 'Mês'))
 
-@app.route("/financeiro/fechar_caixa", methods=['POST'])
+    # Mês fechado só muda com despesa/caixa ('caixa') ou pagamento daquele mês
+    chave_pagamentos = f"pagamentos:{ano}-{mes:02d}"
+
+    def renderizar(versoes):
+        relatorio = db.relatorio_mes(mes, ano)
+        # O histórico refaz o relatório de todos os meses: só recalcula quando 'caixa' muda
+        historico_html = fragmento(('historico_lucro', versoes['caixa']),
+                                   lambda: render_template("_historico_lucro.html", historico=db.get_historico_anual()))
+        return render_template("financeiro.html", relatorio=relatorio, historico_html=historico_html, mes_atual=mes, ano_atual=ano, nome_mes=nomes_meses.get(mes, 'Mês'))
+    return responder_com_etag(['caixa', chave_pagamentos], renderizar)
+
+@rota("/financeiro/fechar_caixa", methods=['POST'])
 @login_required
 def fechar_caixa():
     try:
@@ -224,7 +471,7 @@ def fechar_caixa():
     flash('Caixa detalhado atualizado!', 'success')
     return redirect(url_for('financeiro'))
 
-@app.route("/perfil/alterar_senha", methods=['GET', 'POST'])
+@rota("/perfil/alterar_senha", methods=['GET', 'POST'])
 @login_required
 def alterar_senha():
     if request.method == 'POST':
@@ -257,7 +504,7 @@ def alterar_senha():
         
     return render_template('alterar_senha.html') 
 
-@app.route("/financeiro/despesa", methods=['POST'])
+@rota("/financeiro/despesa", methods=['POST'])
 @login_required
 def nova_despesa():
     desc = request.form.get('descricao')
@@ -268,7 +515,64 @@ def nova_despesa():
         flash('Despesa lançada', 'success')
     return redirect(url_for('financeiro'))
 
-@app.route('/exportar/clientes/csv')
+def _envelhecimento_em_cache(versao_clientes):
+    # Idade muda à meia-noite mesmo sem escrita: a data entra na chave
+    hoje = date.today().isoformat()
+    return hoje, em_cache(('envelhecimento', versao_clientes, hoje), db.relatorio_envelhecimento)
+
+@rota("/relatorios/envelhecimento")
+@login_required
+def relatorio_envelhecimento():
+    def renderizar(versoes):
+        _, linhas = _envelhecimento_em_cache(versoes['clientes'])
+        faixas = ('faixa_0_30', 'faixa_31_60', 'faixa_61_90', 'faixa_90_mais', 'total_aberto')
+        totais = {faixa: sum(linha[faixa] for linha in linhas) for faixa in faixas}
+        return render_template("relatorio_envelhecimento.html", linhas=linhas, totais=totais)
+    return responder_com_etag(['clientes'], renderizar, extra=date.today().isoformat())
+
+@rota('/exportar/envelhecimento/csv')
+@login_required
+def exportar_envelhecimento_csv():
+    """Exporta o relatório de envelhecimento da dívida (ordem de prioridade de cobrança)"""
+    hoje, linhas = _envelhecimento_em_cache(db.buscar_versoes(['clientes'])['clientes'])
+
+    output = StringIO()
+    writer = csv.writer(output)
+
+    output.write("ENVELHECIMENTO DA DÍVIDA - ESTAÇÃO DO LANCHE\n")
+    output.write(f"Data: {datetime.now().strftime('%d/%m/%Y %H:%M')}\n")
+    output.write(f"Clientes devendo: {len(linhas)}\n")
+    output.write("\n")
+
+    writer.writerow(['Prioridade', 'ID', 'Nome do Cliente', '0-30 dias', '31-60 dias', '61-90 dias', '90+ dias',
+                     'Total em Aberto', 'Dívida mais antiga (dias)', 'Dias sem pagar'])
+    for posicao, linha in enumerate(linhas, start=1):
+        writer.writerow([
+            posicao,
+            linha['id'],
+            linha['nome'],
+            f"R$ {linha['faixa_0_30']:.2f}",
+            f"R$ {linha['faixa_31_60']:.2f}",
+            f"R$ {linha['faixa_61_90']:.2f}",
+            f"R$ {linha['faixa_90_mais']:.2f}",
+            f"R$ {linha['total_aberto']:.2f}",
+            linha['dias_divida_mais_antiga'],
+            linha['dias_sem_pagar'] if linha['dias_sem_pagar'] is not None else 'Nunca pagou',
+        ])
+
+    output.seek(0)
+    buffer = BytesIO()
+    buffer.write(output.getvalue().encode('utf-8-sig'))  # UTF-8 com BOM para Excel
+    buffer.seek(0)
+
+    return send_file(
+        buffer,
+        mimetype='text/csv',
+        as_attachment=True,
+        download_name=f"envelhecimento_divida_{hoje.replace('-', '')}.csv"
+    )
+
+@rota('/exportar/clientes/csv')
 @login_required
 def exportar_clientes_csv():
     """Exporta resumo financeiro de todos os clientes em CSV - SUPER LEVE"""
@@ -324,5 +628,31 @@ def exportar_clientes_csv():
         download_name=nome_arquivo
     )
 
+# --- APPLICATION FACTORY ---
+
+def create_app():
+    """Monta a aplicação sem tocar no banco (rápido e seguro para gunicorn --preload)"""
+    app = Flask(__name__)
+    app.secret_key = os.getenv("SECRET_KEY", "chave_secreta_padrao_dev")
+
+    login_manager.init_app(app)
+
+    for regra, funcao, opcoes in ROTAS:
+        app.add_url_rule(regra, view_func=funcao, **opcoes)
+
+    if os.getenv("INIT_DB_AUTOMATICO", "1") == "1":
+        app.before_request(garantir_banco)
+    app.before_request(iniciar_perfil)
+    app.after_request(finalizar_perfil)
+    app.teardown_request(descartar_perfil)
+
+    app.cli.add_command(init_db_comando)
+    app.cli.add_command(agregar_perfis)
+    app.cli.add_command(gerar_snapshots_comando)
+    return app
+
+# Mantém "gunicorn app:app" e "flask --app app" funcionando
+app = create_app()
+
 if __name__ == '__main__':
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,43 @@
+"""Mede quanto tempo um processo novo leva para ficar pronto (import + create_app).
+
+Uso: python benchmark_startup.py [--repeticoes 10]
+
+Por padrão aponta DATABASE_URL para um endereço que não responde: se alguma parte do
+startup voltar a tocar no banco, o tempo sobe para o connect_timeout e fica óbvio.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+CODIGO_MEDIDO = """
+import time
+inicio = time.perf_counter()
+import app
+app.create_app()
+print(time.perf_counter() - inicio)
+"""
+
+
+def medir(repeticoes):
+    ambiente = dict(os.environ)
+    ambiente.setdefault("DATABASE_URL", "postgresql://bench@10.255.255.1:5432/bench?connect_timeout=5")
+    pasta = os.path.dirname(os.path.abspath(__file__))
+
+    tempos = []
+    for _ in range(repeticoes):
+        saida = subprocess.run([sys.executable, "-c", CODIGO_MEDIDO], cwd=pasta, env=ambiente,
+                               capture_output=True, text=True, check=True)
+        tempos.append(float(saida.stdout.strip().splitlines()[-1]) * 1000)
+    return tempos
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeticoes", type=int, default=10)
+    args = parser.parse_args()
+
+    tempos = medir(args.repeticoes)
+    print(f"startup (import + create_app) em {len(tempos)} processos novos:")
+    print(f"  mediana {statistics.median(tempos):.1f} ms | min {min(tempos):.1f} ms | max {max(tempos):.1f} ms")
@@ -1,24 +1,72 @@
 import os
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import psycopg2.errors
+import psycopg2.extensions
+from psycopg2.extras import RealDictCursor, Json
 from datetime import datetime
 from dotenv import load_dotenv
 import calendar
+import json
+import time
 
 load_dotenv()
 
+# A cada N eventos de um cliente grava-se um snapshot do saldo (consulta histórica = snapshot + até N eventos)
+INTERVALO_SNAPSHOT = int(os.getenv("INTERVALO_SNAPSHOT", "50"))
+
+# Lançamento offline mantém a hora em que foi digitado, mas nunca no futuro nem velho demais
+DIAS_MAX_OFFLINE = int(os.getenv("SYNC_DIAS_MAX_OFFLINE", "30"))
+
+# Incrementar sempre que init_db() ganhar tabela/trigger nova
+ESQUEMA_VERSAO = 6
+
+class Conexao(psycopg2.extensions.connection):
+    """Conexão que junta as versões a incrementar na transação e só as grava no commit.
+
+    Incrementar uma chave trava a linha dela em versoes_dados até o fim da transação;
+    gravando tudo no final, em ordem alfabética, duas transações nunca travam as mesmas
+    chaves em ordem trocada (deadlock) e a linha 'clientes' fica travada só no commit.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.versoes_pendentes = set()
+        # Clientes cujo advisory lock do log (ver _travar_clientes) já é desta transação
+        self.clientes_travados = set()
+
+    def aplicar_versoes(self):
+        chaves, self.versoes_pendentes = sorted(self.versoes_pendentes), set()
+        cur = self.cursor()
+        for chave in chaves:
+            cur.execute("""INSERT INTO versoes_dados (chave, versao) VALUES (%s, 1)
+                           ON CONFLICT (chave) DO UPDATE SET versao = versoes_dados.versao + 1""", (chave,))
+
+    def commit(self):
+        if self.versoes_pendentes:
+            self.aplicar_versoes()
+        super().commit()
+        self.clientes_travados.clear()
+
+    def rollback(self):
+        self.versoes_pendentes.clear()
+        self.clientes_travados.clear()
+        super().rollback()
+
 def get_connection():
     """Conecta no Supabase usando a URL do .env"""
     url = os.getenv("DATABASE_URL")
     if not url:
         raise ValueError("A variável DATABASE_URL não foi definida no arquivo .env")
-    conn = psycopg2.connect(url, cursor_factory=RealDictCursor)
+    conn = psycopg2.connect(url, connection_factory=Conexao, cursor_factory=RealDictCursor)
     return conn
 
 def init_db():
     """Cria as tabelas no PostgreSQL"""
     conn = get_connection()
     c = conn.cursor()
+
+    # Vários workers podem rodar init_db() ao mesmo tempo: um de cada vez
+    c.execute("SELECT pg_advisory_xact_lock(hashtext('fiado_init_db'))")
     
     # Usuários
     c.execute('''CREATE TABLE IF NOT EXISTS usuarios 
@@ -52,9 +100,110 @@ def init_db():
                   valor REAL, data_pagamento TIMESTAMP,
                   FOREIGN KEY(cliente_id) REFERENCES clientes(id))''')
 
+    # Versão dos dados por área (clientes, cliente:<id>, caixa, pagamentos:<AAAA-MM>),
+    # incrementada a cada escrita: base dos ETags e do cache de fragmentos
+    c.execute('''CREATE TABLE IF NOT EXISTS versoes_dados 
+                 (chave TEXT PRIMARY KEY, versao BIGINT NOT NULL DEFAULT 0)''')
+
+    # Operações já aplicadas pelo /api/sync (chave de idempotência gerada no aparelho)
+    c.execute('''CREATE TABLE IF NOT EXISTS sync_operacoes 
+                 (chave TEXT PRIMARY KEY, tipo TEXT, resultado TEXT, 
+                  aplicado_em TIMESTAMP DEFAULT NOW())''')
+
+    # Notificações de mudança (LISTEN/NOTIFY) para o painel ao vivo
+    # Só vão no payload as colunas lidas por eventos.montar_delta: o pg_notify recusa
+    # payloads acima de 8000 bytes e derrubaria a própria escrita (ex: descrição longa)
+    c.execute('''CREATE OR REPLACE FUNCTION notificar_mudanca() RETURNS trigger AS $$
+                 DECLARE
+                     campos TEXT[] := ARRAY['cliente_id', 'valor', 'dinheiro', 'moeda', 'cartao', 'pix',
+                                            'data_registro', 'data_pagamento', 'data_despesa', 'data_referencia'];
+                 BEGIN
+                     PERFORM pg_notify('fiado_mudancas', jsonb_build_object(
+                         'tabela', TG_TABLE_NAME,
+                         'operacao', TG_OP,
+                         'novo', CASE WHEN TG_OP <> 'DELETE' THEN
+                             (SELECT jsonb_object_agg(key, value) FROM jsonb_each(to_jsonb(NEW)) WHERE key = ANY(campos)) END,
+                         'antigo', CASE WHEN TG_OP <> 'INSERT' THEN
+                             (SELECT jsonb_object_agg(key, value) FROM jsonb_each(to_jsonb(OLD)) WHERE key = ANY(campos)) END
+                     )::text);
+                     RETURN NULL;
+                 END;
+                 $$ LANGUAGE plpgsql''')
+
+    for tabela in ('fiados', 'pagamentos', 'despesas', 'caixa_detalhe'):
+        c.execute(f"DROP TRIGGER IF EXISTS {tabela}_notificar ON {tabela}")
+        c.execute(f'''CREATE TRIGGER {tabela}_notificar
+                      AFTER INSERT OR UPDATE OR DELETE ON {tabela}
+                      FOR EACH ROW EXECUTE FUNCTION notificar_mudanca()''')
+
+    # Log de auditoria (só INSERT): toda mutação grava um evento na mesma transação.
+    # criado_em = quando foi gravado; efetivo_em = data do fato (data_registro/data_pagamento),
+    # que pode ser anterior num lançamento offline. NULL = igual a criado_em (importados e eventos sem data própria)
+    c.execute('''CREATE TABLE IF NOT EXISTS eventos_auditoria 
+                 (id BIGSERIAL PRIMARY KEY, criado_em TIMESTAMP NOT NULL DEFAULT NOW(), 
+                  tipo TEXT NOT NULL, cliente_id INTEGER, 
+                  delta_saldo REAL NOT NULL DEFAULT 0.0, dados JSONB, efetivo_em TIMESTAMP)''')
+    c.execute("ALTER TABLE eventos_auditoria ADD COLUMN IF NOT EXISTS efetivo_em TIMESTAMP")
+    c.execute("CREATE INDEX IF NOT EXISTS eventos_auditoria_cliente_idx ON eventos_auditoria (cliente_id, id)")
+    c.execute("CREATE INDEX IF NOT EXISTS eventos_auditoria_cliente_criado_idx ON eventos_auditoria (cliente_id, criado_em)")
+
+    # Append-only de verdade: UPDATE, DELETE e TRUNCATE no log falham, venham de onde vierem
+    c.execute('''CREATE OR REPLACE FUNCTION rejeitar_alteracao_auditoria() RETURNS trigger AS $$
+                 BEGIN
+                     RAISE EXCEPTION 'eventos_auditoria é somente inserção (% recusado)', TG_OP;
+                 END;
+                 $$ LANGUAGE plpgsql''')
+    c.execute("DROP TRIGGER IF EXISTS eventos_auditoria_imutavel ON eventos_auditoria")
+    c.execute('''CREATE TRIGGER eventos_auditoria_imutavel
+                 BEFORE UPDATE OR DELETE ON eventos_auditoria
+                 FOR EACH ROW EXECUTE FUNCTION rejeitar_alteracao_auditoria()''')
+    c.execute("DROP TRIGGER IF EXISTS eventos_auditoria_sem_truncate ON eventos_auditoria")
+    c.execute('''CREATE TRIGGER eventos_auditoria_sem_truncate
+                 BEFORE TRUNCATE ON eventos_auditoria
+                 FOR EACH STATEMENT EXECUTE FUNCTION rejeitar_alteracao_auditoria()''')
+
+    # Saldo acumulado do cliente até um evento (sem FK: o histórico sobrevive à exclusão do cliente)
+    c.execute('''CREATE TABLE IF NOT EXISTS snapshots_saldo 
+                 (cliente_id INTEGER NOT NULL, ate_evento_id BIGINT NOT NULL, 
+                  saldo REAL NOT NULL, criado_em TIMESTAMP NOT NULL, 
+                  PRIMARY KEY (cliente_id, ate_evento_id))''')
+
+    # Primeira vez: importa o histórico existente para o log, em ordem cronológica
+    c.execute("SELECT EXISTS (SELECT 1 FROM eventos_auditoria) AS tem")
+    if not c.fetchone()['tem']:
+        c.execute('''INSERT INTO eventos_auditoria (criado_em, tipo, cliente_id, delta_saldo, dados)
+                     SELECT criado_em, tipo, cliente_id, delta_saldo, dados FROM (
+                         SELECT COALESCE(data_registro, NOW()) AS criado_em, 'fiado_importado' AS tipo, cliente_id,
+                                valor AS delta_saldo, jsonb_build_object('fiado_id', id, 'descricao', descricao, 'valor', valor) AS dados
+                         FROM fiados
+                         UNION ALL
+                         SELECT COALESCE(data_pagamento, NOW()), 'pagamento_importado', cliente_id,
+                                -valor, jsonb_build_object('pagamento_id', id, 'valor', valor)
+                         FROM pagamentos
+                     ) historico
+                     ORDER BY criado_em''')
+        _gerar_snapshots(c)
+
+    c.execute("CREATE TABLE IF NOT EXISTS esquema_versao (versao INTEGER)")
+    c.execute("DELETE FROM esquema_versao")
+    c.execute("INSERT INTO esquema_versao (versao) VALUES (%s)", (ESQUEMA_VERSAO,))
+
     conn.commit()
     conn.close()
 
+def esquema_pendente():
+    """True se o banco ainda não tem o esquema desta versão do código (uma consulta barata)"""
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT to_regclass('esquema_versao') AS tabela")
+        if cur.fetchone()['tabela'] is None:
+            return True
+        cur.execute("SELECT MAX(versao) AS v FROM esquema_versao")
+        return (cur.fetchone()['v'] or 0) < ESQUEMA_VERSAO
+    finally:
+        conn.close()
+
 def criar_usuario(username, password_hash):
     conn = get_connection()
     try:
@@ -88,6 +237,127 @@ def atualizar_senha_usuario(user_id, novo_password_hash):
     conn.commit()
     conn.close()
 
+# --- VERSÕES DOS DADOS (CACHE / ETAG) ---
+
+def _incrementar_versao(cur, *chaves):
+    """Marca as chaves para incremento; a gravação acontece no commit da mesma transação (Conexao)"""
+    cur.connection.versoes_pendentes.update(chaves)
+
+def buscar_versoes(chaves):
+    """Retorna {chave: versao}; chave nunca escrita vale 0"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT chave, versao FROM versoes_dados WHERE chave = ANY(%s)", (list(chaves),))
+    encontradas = {row['chave']: row['versao'] for row in cur.fetchall()}
+    conn.close()
+    return {chave: encontradas.get(chave, 0) for chave in chaves}
+
+# --- LOG DE AUDITORIA E SALDO HISTÓRICO ---
+
+def _json_dados(dados):
+    return Json(dados, dumps=lambda valor: json.dumps(valor, default=str))
+
+def _travar_clientes(cur, clientes_ids):
+    """Trava o log de auditoria dos clientes até o fim da transação, em ordem crescente de id.
+
+    Serializa os eventos de cada cliente: sem isso duas transações contam a mesma cauda,
+    nenhuma vê o evento da outra e o snapshot sai com saldo errado (ou some). Quem escreve
+    em vários clientes trava todos antes, de uma vez, para a ordem não depender do lote.
+    """
+    travados = cur.connection.clientes_travados
+    for cliente_id in sorted({int(cliente_id) for cliente_id in clientes_ids} - travados):
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext('snapshot_saldo'), %s)", (cliente_id,))
+        travados.add(cliente_id)
+
+def _registrar_evento(cur, tipo, cliente_id=None, delta_saldo=0.0, dados=None, efetivo_em=None):
+    """Grava o evento na transação da mutação e, a cada INTERVALO_SNAPSHOT eventos do cliente, um snapshot.
+
+    efetivo_em: data do fato quando difere da gravação (fiado/pagamento lançado offline).
+    """
+    if cliente_id is not None:
+        _travar_clientes(cur, [cliente_id])
+    cur.execute("""INSERT INTO eventos_auditoria (tipo, cliente_id, delta_saldo, dados, efetivo_em)
+                   VALUES (%s, %s, %s, %s, %s) RETURNING id, criado_em""",
+                (tipo, cliente_id, delta_saldo, _json_dados(dados or {}), efetivo_em))
+    evento = cur.fetchone()
+    if cliente_id is None:
+        return
+
+    cur.execute("SELECT ate_evento_id, saldo FROM snapshots_saldo WHERE cliente_id = %s ORDER BY ate_evento_id DESC LIMIT 1",
+                (cliente_id,))
+    snapshot = cur.fetchone()
+    desde = snapshot['ate_evento_id'] if snapshot else 0
+
+    cur.execute("""SELECT COUNT(*) AS eventos, COALESCE(SUM(delta_saldo), 0.0) AS soma
+                   FROM eventos_auditoria WHERE cliente_id = %s AND id > %s AND id <= %s""",
+                (cliente_id, desde, evento['id']))
+    cauda = cur.fetchone()
+    if cauda['eventos'] >= INTERVALO_SNAPSHOT:
+        saldo = (snapshot['saldo'] if snapshot else 0.0) + cauda['soma']
+        cur.execute("INSERT INTO snapshots_saldo (cliente_id, ate_evento_id, saldo, criado_em) VALUES (%s, %s, %s, %s)",
+                    (cliente_id, evento['id'], saldo, evento['criado_em']))
+
+def _gerar_snapshots(cur):
+    """Recria os snapshots a cada INTERVALO_SNAPSHOT eventos de cada cliente (set-based)"""
+    cur.execute("""
+        INSERT INTO snapshots_saldo (cliente_id, ate_evento_id, saldo, criado_em)
+        SELECT cliente_id, id, saldo, criado_em FROM (
+            SELECT
+                cliente_id, id, criado_em,
+                SUM(delta_saldo) OVER (PARTITION BY cliente_id ORDER BY id) AS saldo,
+                ROW_NUMBER() OVER (PARTITION BY cliente_id ORDER BY id) AS n
+            FROM eventos_auditoria
+            WHERE cliente_id IS NOT NULL
+        ) acumulado
+        WHERE n %% %s = 0
+        ON CONFLICT (cliente_id, ate_evento_id) DO NOTHING
+    """, (INTERVALO_SNAPSHOT,))
+
+def gerar_snapshots():
+    conn = get_connection()
+    cur = conn.cursor()
+    _gerar_snapshots(cur)
+    conn.commit()
+    conn.close()
+
+def saldo_cliente_em(cliente_id, momento):
+    """Quanto o cliente devia em `momento`, pela data do fato (efetivo_em), como em fiados/pagamentos.
+
+    Último snapshot gravado até `momento` + a cauda de eventos com efetivo_em até lá. Como
+    efetivo_em fica no máximo DIAS_MAX_OFFLINE dias antes de criado_em, a cauda só precisa
+    olhar o que foi gravado até `momento` + DIAS_MAX_OFFLINE dias.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""SELECT ate_evento_id, saldo FROM snapshots_saldo
+                   WHERE cliente_id = %s AND criado_em <= %s
+                   ORDER BY ate_evento_id DESC LIMIT 1""", (cliente_id, momento))
+    snapshot = cur.fetchone()
+    desde = snapshot['ate_evento_id'] if snapshot else 0
+
+    # O snapshot já inclui tudo até ele (efetivo_em <= criado_em); lançamentos offline
+    # gravados depois mas datados antes de `momento` entram pela cauda
+    cur.execute(f"""SELECT COALESCE(SUM(delta_saldo), 0.0) AS soma FROM eventos_auditoria
+                    WHERE cliente_id = %s AND id > %s
+                      AND criado_em <= %s::timestamp + INTERVAL '{DIAS_MAX_OFFLINE} days'
+                      AND COALESCE(efetivo_em, criado_em) <= %s""",
+                (cliente_id, desde, momento, momento))
+    soma = cur.fetchone()['soma']
+    conn.close()
+    return (snapshot['saldo'] if snapshot else 0.0) + soma
+
+def buscar_eventos_cliente(cliente_id, ate=None, limite=50):
+    """Eventos mais recentes do cliente (até `ate`, se informado) para explicar o saldo"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("""SELECT id, criado_em, COALESCE(efetivo_em, criado_em) AS efetivo_em, tipo, delta_saldo, dados
+                   FROM eventos_auditoria
+                   WHERE cliente_id = %s AND (%s::timestamp IS NULL OR COALESCE(efetivo_em, criado_em) <= %s)
+                   ORDER BY id DESC LIMIT %s""", (cliente_id, ate, ate, limite))
+    eventos = cur.fetchall()
+    conn.close()
+    return eventos
+
 # --- LÓGICA FINANCEIRA ---
 
 def get_saldo_cliente(cliente_id):
@@ -107,10 +377,20 @@ def get_saldo_cliente(cliente_id):
 def registrar_pagamento_abatimento(cliente_id, valor_pago):
     conn = get_connection()
     cur = conn.cursor()
-    
-    # 1. Registrar pagamento
-    cur.execute("INSERT INTO pagamentos (cliente_id, valor, data_pagamento) VALUES (%s, %s, NOW())", 
-                 (cliente_id, valor_pago))
+    _registrar_pagamento(cur, cliente_id, valor_pago)
+    conn.commit()
+    conn.close()
+
+def _registrar_pagamento(cur, cliente_id, valor_pago, data_cliente=None):
+    """Insere o pagamento e dá baixa visual nos fiados mais antigos (sem commit)"""
+    # 1. Registrar pagamento (data_cliente: hora do lançamento offline, limitada em _DATA_LIMITADA_SQL)
+    cur.execute(f"INSERT INTO pagamentos (cliente_id, valor, data_pagamento) VALUES (%s, %s, {_DATA_LIMITADA_SQL}) RETURNING id, data_pagamento", 
+                 (cliente_id, valor_pago, data_cliente))
+    pagamento = cur.fetchone()
+    data_pagamento = pagamento['data_pagamento']
+    _registrar_evento(cur, 'pagamento_registrado', cliente_id, -valor_pago, {"pagamento_id": pagamento['id'], "valor": valor_pago},
+                      efetivo_em=data_pagamento)
+    _incrementar_versao(cur, 'clientes', f'cliente:{cliente_id}', f"pagamentos:{data_pagamento:%Y-%m}")
     
     # 2. Baixa visual (Item por item)
     cur.execute("SELECT id, valor FROM fiados WHERE cliente_id = %s AND pago = FALSE ORDER BY data_registro ASC", (cliente_id,))
@@ -135,9 +415,6 @@ def registrar_pagamento_abatimento(cliente_id, valor_pago):
             saldo_visual -= item['valor']
         else:
             break
-            
-    conn.commit()
-    conn.close()
 
 # --- CLIENTES E FIADOS ---
 
@@ -182,15 +459,20 @@ def buscar_cliente(id):
 def inserir_cliente(nome):
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("INSERT INTO clientes (nome) VALUES (%s)", (nome,))
+    cur.execute("INSERT INTO clientes (nome) VALUES (%s) RETURNING id", (nome,))
+    _registrar_evento(cur, 'cliente_criado', cur.fetchone()['id'], 0.0, {"nome": nome})
+    _incrementar_versao(cur, 'clientes')
     conn.commit()
     conn.close()
 
 def inserir_fiado(cliente_id, descricao, valor):
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("INSERT INTO fiados (cliente_id, descricao, valor, data_registro) VALUES (%s, %s, %s, NOW())",
+    cur.execute("INSERT INTO fiados (cliente_id, descricao, valor, data_registro) VALUES (%s, %s, %s, NOW()) RETURNING id",
                  (cliente_id, descricao, valor))
+    _registrar_evento(cur, 'fiado_registrado', cliente_id, valor,
+                      {"fiado_id": cur.fetchone()['id'], "descricao": descricao, "valor": valor})
+    _incrementar_versao(cur, 'clientes', f'cliente:{cliente_id}')
     conn.commit()
     conn.close()
 
@@ -198,7 +480,11 @@ def excluir_fiado_por_id(fiado_id):
     conn = get_connection()
     try:
         cur = conn.cursor()
-        cur.execute("DELETE FROM fiados WHERE id = %s", (fiado_id,))
+        cur.execute("DELETE FROM fiados WHERE id = %s RETURNING *", (fiado_id,))
+        excluido = cur.fetchone()
+        if excluido:
+            _registrar_evento(cur, 'fiado_excluido', excluido['cliente_id'], -excluido['valor'], dict(excluido))
+            _incrementar_versao(cur, 'clientes', f"cliente:{excluido['cliente_id']}")
         conn.commit()
         return True
     except Exception as e:
@@ -252,12 +538,98 @@ def buscar_ultimos_pagamentos(cliente_id, limite=3):
 def excluir_cliente_completo(cliente_id):
     conn = get_connection()
     cur = conn.cursor()
-    cur.execute("DELETE FROM fiados WHERE cliente_id = %s", (cliente_id,))
-    cur.execute("DELETE FROM pagamentos WHERE cliente_id = %s", (cliente_id,))
-    cur.execute("DELETE FROM clientes WHERE id = %s", (cliente_id,))
+    cur.execute("DELETE FROM fiados WHERE cliente_id = %s RETURNING *", (cliente_id,))
+    fiados = [dict(f) for f in cur.fetchall()]
+    cur.execute("DELETE FROM pagamentos WHERE cliente_id = %s RETURNING *", (cliente_id,))
+    pagamentos = [dict(p) for p in cur.fetchall()]
+    cur.execute("DELETE FROM clientes WHERE id = %s RETURNING nome", (cliente_id,))
+    cliente = cur.fetchone()
+
+    # O evento guarda tudo que foi apagado e zera o saldo do cliente no log
+    saldo = sum(f['valor'] for f in fiados) - sum(p['valor'] for p in pagamentos)
+    _registrar_evento(cur, 'cliente_excluido', cliente_id, -saldo,
+                      {"nome": cliente['nome'] if cliente else None, "fiados": fiados, "pagamentos": pagamentos})
+    # Pagamentos de meses passados somem do "recuperado": invalida o financeiro inteiro
+    _incrementar_versao(cur, 'clientes', f'cliente:{cliente_id}', 'caixa')
     conn.commit()
     conn.close()
 
+def relatorio_envelhecimento():
+    """Dívida de todos os clientes por idade (0-30, 31-60, 61-90, 90+ dias), numa consulta só.
+
+    Os pagamentos abatem os fiados mais antigos primeiro (FIFO, mesma regra de
+    buscar_itens_pendentes); o que sobra de cada fiado entra na faixa da sua data_registro.
+    prioridade pondera as faixas antigas (1x, 2x, 3x, 4x) para ordenar a cobrança.
+    """
+    conn = get_connection()
+    cur = conn.cursor()
+
+    query = """
+        WITH pagos AS (
+            SELECT cliente_id, SUM(valor) AS total_pago, MAX(data_pagamento) AS ultimo_pagamento
+            FROM pagamentos
+            GROUP BY cliente_id
+        ),
+        acumulado AS (
+            SELECT
+                cliente_id,
+                valor,
+                CURRENT_DATE - DATE(data_registro) AS idade,
+                SUM(valor) OVER (PARTITION BY cliente_id ORDER BY data_registro, id) AS acumulado
+            FROM fiados
+        ),
+        cobertura AS (
+            -- Quanto de cada fiado ainda não foi coberto pelo total pago do cliente
+            SELECT
+                a.cliente_id,
+                a.idade,
+                LEAST(a.valor, GREATEST(a.acumulado - COALESCE(p.total_pago, 0.0), 0.0)) AS restante
+            FROM acumulado a
+            LEFT JOIN pagos p ON p.cliente_id = a.cliente_id
+        ),
+        abertos AS (
+            -- Somas em float deixam resíduos tipo 1e-13 em fiados já quitados: abaixo de
+            -- meio centavo conta como zero, senão o fiado cai numa faixa e vira "o mais antigo"
+            SELECT cliente_id, idade, CASE WHEN restante > 0.005 THEN restante ELSE 0.0 END AS restante
+            FROM cobertura
+        ),
+        faixas AS (
+            SELECT
+                cliente_id,
+                COALESCE(SUM(restante) FILTER (WHERE idade <= 30), 0.0) AS faixa_0_30,
+                COALESCE(SUM(restante) FILTER (WHERE idade BETWEEN 31 AND 60), 0.0) AS faixa_31_60,
+                COALESCE(SUM(restante) FILTER (WHERE idade BETWEEN 61 AND 90), 0.0) AS faixa_61_90,
+                COALESCE(SUM(restante) FILTER (WHERE idade > 90), 0.0) AS faixa_90_mais,
+                SUM(restante) AS total_aberto,
+                MAX(idade) FILTER (WHERE restante > 0) AS dias_divida_mais_antiga
+            FROM abertos
+            GROUP BY cliente_id
+        )
+        SELECT
+            c.id,
+            c.nome,
+            f.faixa_0_30,
+            f.faixa_31_60,
+            f.faixa_61_90,
+            f.faixa_90_mais,
+            f.total_aberto,
+            f.dias_divida_mais_antiga,
+            p.ultimo_pagamento,
+            CURRENT_DATE - DATE(p.ultimo_pagamento) AS dias_sem_pagar,
+            f.faixa_0_30 + 2 * f.faixa_31_60 + 3 * f.faixa_61_90 + 4 * f.faixa_90_mais AS prioridade
+        FROM faixas f
+        JOIN clientes c ON c.id = f.cliente_id
+        LEFT JOIN pagos p ON p.cliente_id = f.cliente_id
+        WHERE f.total_aberto > 0.005
+        ORDER BY prioridade DESC, f.total_aberto DESC
+    """
+
+    cur.execute(query)
+    linhas = cur.fetchall()
+    conn.close()
+
+    return [dict(linha) for linha in linhas]
+
 def get_dashboard_totals():
     conn = get_connection()
     cur = conn.cursor()
@@ -282,8 +654,11 @@ def inserir_despesa(descricao, valor, categoria):
     conn = get_connection()
     try:
         cur = conn.cursor()
-        cur.execute("INSERT INTO despesas (descricao, valor, categoria, data_despesa) VALUES (%s, %s, %s, CURRENT_DATE)",
+        cur.execute("INSERT INTO despesas (descricao, valor, categoria, data_despesa) VALUES (%s, %s, %s, CURRENT_DATE) RETURNING id",
                     (descricao, valor, categoria))
+        _registrar_evento(cur, 'despesa_registrada', dados={"despesa_id": cur.fetchone()['id'], "descricao": descricao,
+                                                             "valor": valor, "categoria": categoria})
+        _incrementar_versao(cur, 'caixa')
         conn.commit()
     except Exception as e:
         print(f"Erro ao inserir despesa: {e}")
@@ -309,7 +684,7 @@ def fechar_caixa_dia(dinheiro, moeda, cartao, pix, observacao=""):
     conn = get_connection()
     cur = conn.cursor()
     
-    cur.execute("SELECT id FROM caixa_detalhe WHERE data_referencia = CURRENT_DATE")
+    cur.execute("SELECT * FROM caixa_detalhe WHERE data_referencia = CURRENT_DATE")
     exists = cur.fetchone()
     
     if exists:
@@ -318,6 +693,13 @@ def fechar_caixa_dia(dinheiro, moeda, cartao, pix, observacao=""):
     else:
         cur.execute("INSERT INTO caixa_detalhe (data_referencia, dinheiro, moeda, cartao, pix, observacao) VALUES (CURRENT_DATE, %s, %s, %s, %s, %s)", 
                     (dinheiro, moeda, cartao, pix, observacao))
+
+    # Guarda os valores sobrescritos para o fechamento poder ser explicado depois
+    _registrar_evento(cur, 'caixa_fechado', dados={
+        "anterior": dict(exists) if exists else None,
+        "novo": {"dinheiro": dinheiro, "moeda": moeda, "cartao": cartao, "pix": pix, "observacao": observacao},
+    })
+    _incrementar_versao(cur, 'caixa')
     conn.commit()
     conn.close()
 
@@ -492,4 +874,249 @@ def exportar_resumo_clientes():
     clientes = cur.fetchall()
     conn.close()
     
-    return [dict(c) for c in clientes]
\ No newline at end of file
+    return [dict(c) for c in clientes]
+
+# --- SINCRONIZAÇÃO OFFLINE (/api/sync) ---
+
+TIPOS_SYNC = ('cliente', 'fiado', 'pagamento', 'despesa')
+TENTATIVAS_SYNC = 3
+
+_DATA_LIMITADA_SQL = f"LEAST(GREATEST(COALESCE(%s::timestamptz, NOW()), NOW() - INTERVAL '{DIAS_MAX_OFFLINE} days'), NOW())"
+
+class OperacaoSyncInvalida(ValueError):
+    """Operação do lote que não pode ser aplicada; `chave` identifica qual tirar da fila"""
+
+    def __init__(self, chave, mensagem):
+        super().__init__(mensagem)
+        self.chave = chave
+
+def _mensagem_erro_sync(erro):
+    """Texto curto para o aviso do balcão; o detalhe do PostgreSQL fica só no log"""
+    if isinstance(erro, psycopg2.errors.ForeignKeyViolation):
+        return "cliente não existe mais"
+    if isinstance(erro, psycopg2.Error):
+        print(f"Erro ao aplicar operação do sync: {erro}")
+        return "dados recusados pelo banco"
+    if isinstance(erro, TypeError):
+        return "dados inválidos"
+    return str(erro)
+
+def _ler_cursor_sync(cursor):
+    """Cursor = {"<cliente_id>": versão da chave cliente:<id>} visto pelo aparelho.
+
+    Qualquer outro formato (inclusive o antigo, por ids) vira None: ressincronização completa.
+    """
+    if not isinstance(cursor, dict):
+        return None
+    try:
+        return {int(cliente_id): int(versao) for cliente_id, versao in cursor.items()}
+    except (TypeError, ValueError):
+        return None
+
+def _data_cliente(dados):
+    """Hora informada pelo aparelho (ISO 8601) ou None para usar NOW()"""
+    valor = dados.get('registrado_em')
+    if not valor:
+        return None
+    try:
+        return datetime.fromisoformat(str(valor).replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"registrado_em inválido: {valor}")
+
+def _resolver_cliente(dados, resultados):
+    """Aceita cliente_id real ou cliente_ref (chave de uma operação 'cliente' do mesmo lote/lote anterior)"""
+    if dados.get('cliente_ref'):
+        resultado = resultados.get(dados['cliente_ref'])
+        if not resultado or 'cliente_id' not in resultado:
+            raise ValueError(f"cliente_ref desconhecido: {dados['cliente_ref']}")
+        return resultado['cliente_id']
+    if not dados.get('cliente_id'):
+        raise ValueError("Operação sem cliente_id")
+    return int(dados['cliente_id'])
+
+def _valor_positivo(dados):
+    valor = float(str(dados.get('valor', '0')).replace(',', '.'))
+    if valor <= 0:
+        raise ValueError("Valor deve ser positivo")
+    return valor
+
+def _aplicar_operacao_sync(cur, tipo, dados, resultados):
+    if tipo == 'cliente':
+        nome = str(dados.get('nome') or '').strip()
+        if not nome:
+            raise ValueError("O nome do cliente não pode ser vazio")
+        cur.execute("SELECT id FROM clientes WHERE nome ILIKE %s", (nome,))
+        existente = cur.fetchone()
+        if existente:
+            return {"cliente_id": existente['id']}
+        cur.execute("INSERT INTO clientes (nome) VALUES (%s) RETURNING id", (nome,))
+        cliente_id = cur.fetchone()['id']
+        _registrar_evento(cur, 'cliente_criado', cliente_id, 0.0, {"nome": nome})
+        _incrementar_versao(cur, 'clientes', f'cliente:{cliente_id}')
+        return {"cliente_id": cliente_id}
+
+    if tipo == 'fiado':
+        cliente_id = _resolver_cliente(dados, resultados)
+        valor = _valor_positivo(dados)
+        cur.execute(f"INSERT INTO fiados (cliente_id, descricao, valor, data_registro) VALUES (%s, %s, %s, {_DATA_LIMITADA_SQL}) RETURNING id, data_registro",
+                    (cliente_id, dados.get('descricao'), valor, _data_cliente(dados)))
+        fiado = cur.fetchone()
+        fiado_id = fiado['id']
+        _registrar_evento(cur, 'fiado_registrado', cliente_id, valor,
+                          {"fiado_id": fiado_id, "descricao": dados.get('descricao'), "valor": valor},
+                          efetivo_em=fiado['data_registro'])
+        _incrementar_versao(cur, 'clientes', f'cliente:{cliente_id}')
+        return {"cliente_id": cliente_id, "fiado_id": fiado_id}
+
+    if tipo == 'pagamento':
+        cliente_id = _resolver_cliente(dados, resultados)
+        _registrar_pagamento(cur, cliente_id, _valor_positivo(dados), _data_cliente(dados))
+        return {"cliente_id": cliente_id}
+
+    if tipo == 'despesa':
+        valor = _valor_positivo(dados)
+        cur.execute(f"INSERT INTO despesas (descricao, valor, categoria, data_despesa) VALUES (%s, %s, %s, DATE({_DATA_LIMITADA_SQL})) RETURNING id",
+                    (dados.get('descricao'), valor, dados.get('categoria'), _data_cliente(dados)))
+        despesa_id = cur.fetchone()['id']
+        _registrar_evento(cur, 'despesa_registrada', dados={"despesa_id": despesa_id, "descricao": dados.get('descricao'),
+                                                             "valor": valor, "categoria": dados.get('categoria')})
+        _incrementar_versao(cur, 'caixa')
+        return {"despesa_id": despesa_id}
+
+    raise ValueError(f"Tipo de operação desconhecido: {tipo}")
+
+def _deltas_desde(cur, cursor):
+    """Clientes cuja versão (cliente:<id>) mudou desde o cursor, e os que foram excluídos.
+
+    A versão é incrementada em toda escrita do cliente, inclusive exclusões, então não
+    depende da ordem dos ids nem da ordem de commit como um "maior id visto" dependeria.
+    """
+    cur.execute("""
+        SELECT c.id, COALESCE(v.versao, 0) AS versao
+        FROM clientes c
+        LEFT JOIN versoes_dados v ON v.chave = 'cliente:' || c.id
+    """)
+    versoes = {row['id']: row['versao'] for row in cur.fetchall()}
+    visto = cursor or {}
+
+    mudaram = [cliente_id for cliente_id, versao in versoes.items() if cursor is None or visto.get(cliente_id) != versao]
+    clientes = []
+    if mudaram:
+        cur.execute("""
+            SELECT
+                c.id,
+                c.nome,
+                COALESCE((SELECT SUM(valor) FROM fiados WHERE cliente_id = c.id), 0.0)
+                  - COALESCE((SELECT SUM(valor) FROM pagamentos WHERE cliente_id = c.id), 0.0) AS divida_total
+            FROM clientes c
+            WHERE c.id = ANY(%s)
+            ORDER BY c.id
+        """, (mudaram,))
+        clientes = [dict(c) for c in cur.fetchall()]
+
+    return {
+        "cursor": {str(cliente_id): versao for cliente_id, versao in versoes.items()},
+        "clientes": clientes,
+        "removidos": sorted(cliente_id for cliente_id in visto if cliente_id not in versoes),
+    }
+
+def _clientes_do_lote(cur, operacoes):
+    """Ids dos clientes já existentes que o lote vai tocar (para travar antes, em ordem).
+
+    Operações malformadas são ignoradas aqui; quem as recusa é o laço de aplicar_lote_sync.
+    """
+    ids, refs, nomes = set(), set(), []
+    for op in operacoes:
+        dados = op.get('dados') if isinstance(op, dict) else None
+        if not isinstance(dados, dict):
+            continue
+        if op.get('tipo') == 'cliente' and dados.get('nome'):
+            nomes.append(str(dados['nome']).strip())
+        elif dados.get('cliente_ref'):
+            refs.add(str(dados['cliente_ref']))
+        elif dados.get('cliente_id'):
+            try:
+                ids.add(int(dados['cliente_id']))
+            except (TypeError, ValueError):
+                pass
+
+    if refs:
+        # cliente_ref de um lote anterior: o id já está no resultado gravado
+        cur.execute("SELECT resultado FROM sync_operacoes WHERE chave = ANY(%s) AND resultado IS NOT NULL", (list(refs),))
+        ids.update(json.loads(row['resultado']).get('cliente_id') for row in cur.fetchall())
+    if nomes:
+        cur.execute("SELECT id FROM clientes WHERE nome ILIKE ANY(%s)", (nomes,))
+        ids.update(row['id'] for row in cur.fetchall())
+    ids.discard(None)
+    return ids
+
+def aplicar_lote_sync(operacoes, cursor=None):
+    """Aplica um lote de operações offline em UMA transação e devolve os deltas desde o cursor.
+
+    Cada operação: {"chave": "<uuid>", "tipo": "fiado", "dados": {...}}.
+    Chaves já aplicadas (neste lote, em lote anterior ou em outro envio simultâneo) não
+    são reaplicadas: o resultado gravado é devolvido. Uma operação com erro desfaz o lote
+    inteiro e sobe como OperacaoSyncInvalida com a chave dela. Deadlock ou falha de
+    serialização refaz o lote algumas vezes antes de subir o erro.
+    """
+    for tentativa in range(TENTATIVAS_SYNC):
+        try:
+            return _aplicar_lote_sync(operacoes, cursor)
+        except psycopg2.errors.TransactionRollbackError:
+            if tentativa == TENTATIVAS_SYNC - 1:
+                raise
+            time.sleep(0.05 * (tentativa + 1))
+
+def _aplicar_lote_sync(operacoes, cursor):
+    cursor_lido = _ler_cursor_sync(cursor)
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        resultados = {}
+        _travar_clientes(cur, _clientes_do_lote(cur, operacoes))
+
+        for op in operacoes:
+            if not isinstance(op, dict):
+                raise ValueError("Toda operação deve ser um objeto")
+            chave, tipo, dados = op.get('chave'), op.get('tipo'), op.get('dados') or {}
+            if not chave or not isinstance(chave, str):
+                raise ValueError("Toda operação precisa de uma chave de idempotência")
+            if chave in resultados:
+                continue
+            if tipo not in TIPOS_SYNC:
+                raise OperacaoSyncInvalida(chave, f"tipo de operação desconhecido: {tipo}")
+            if not isinstance(dados, dict):
+                raise OperacaoSyncInvalida(chave, "'dados' deve ser um objeto")
+
+            # Reserva a chave antes de aplicar: outro envio com a mesma chave espera este
+            # commit e então cai no ON CONFLICT, lendo o resultado já gravado
+            cur.execute("""INSERT INTO sync_operacoes (chave, tipo) VALUES (%s, %s)
+                           ON CONFLICT (chave) DO NOTHING RETURNING chave""", (chave, tipo))
+            if cur.fetchone() is None:
+                cur.execute("SELECT resultado FROM sync_operacoes WHERE chave = %s", (chave,))
+                resultados[chave] = json.loads(cur.fetchone()['resultado'] or '{}')
+                continue
+
+            try:
+                resultado = _aplicar_operacao_sync(cur, tipo, dados, resultados)
+            except psycopg2.OperationalError:
+                raise  # conexão/deadlock: problema passageiro, o lote todo tenta de novo
+            except (TypeError, ValueError, psycopg2.Error) as e:
+                # Ex: cliente excluído enquanto o aparelho estava offline (violação de FK)
+                raise OperacaoSyncInvalida(chave, _mensagem_erro_sync(e))
+
+            cur.execute("UPDATE sync_operacoes SET resultado = %s WHERE chave = %s", (json.dumps(resultado), chave))
+            resultados[chave] = resultado
+
+        # As versões deste lote precisam entrar no cursor devolvido
+        conn.aplicar_versoes()
+        deltas = _deltas_desde(cur, cursor_lido)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+    deltas["resultados"] = resultados
+    return deltas
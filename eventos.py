@@ -0,0 +1,135 @@
+import json
+import os
+import queue
+import select
+import threading
+import time
+from datetime import date
+
+import db
+
+# Canal usado pelos triggers criados em db.init_db()
+CANAL = 'fiado_mudancas'
+
+# Cada painel aberto segura uma thread do gunicorn (gthread). O limite fica abaixo de
+# GUNICORN_THREADS para sobrar thread para as páginas normais; passando dele, /eventos
+# responde 503 e o painel funciona sem ao vivo até tentar de novo.
+MAX_ASSINANTES = int(os.getenv("SSE_MAX_POR_PROCESSO", "4"))
+
+# Coluna de data de cada tabela observada (para saber se o evento é "de hoje")
+COLUNAS_DATA = {
+    'fiados': 'data_registro',
+    'pagamentos': 'data_pagamento',
+    'despesas': 'data_despesa',
+    'caixa_detalhe': 'data_referencia',
+}
+
+
+def _valor_linha(tabela, linha):
+    if not linha:
+        return 0.0
+    if tabela == 'caixa_detalhe':
+        return sum(linha.get(campo) or 0.0 for campo in ('dinheiro', 'moeda', 'cartao', 'pix'))
+    return linha.get('valor') or 0.0
+
+
+def montar_delta(payload):
+    """Transforma o payload do NOTIFY em um delta pronto para o painel.
+
+    Ex: {"tabela": "fiados", "cliente_id": 7, "delta": 12.5, "hoje": true}
+    Retorna None quando a mudança não altera nenhum total (ex: baixa visual de fiado).
+    """
+    tabela = payload.get('tabela')
+    novo = payload.get('novo')
+    antigo = payload.get('antigo')
+    linha = novo or antigo or {}
+
+    delta = round(_valor_linha(tabela, novo) - _valor_linha(tabela, antigo), 2)
+    if delta == 0:
+        return None
+
+    data_linha = str(linha.get(COLUNAS_DATA.get(tabela)) or '')[:10]
+    return {
+        "tabela": tabela,
+        "operacao": payload.get('operacao'),
+        "cliente_id": linha.get('cliente_id'),
+        "delta": delta,
+        "hoje": data_linha == date.today().isoformat(),
+    }
+
+
+class Transmissor:
+    """Um único LISTEN por processo, repassando os deltas para cada conexão SSE aberta.
+
+    A thread de escuta só sobe quando o primeiro painel se conecta, então importar
+    o módulo não abre conexão nenhuma com o banco.
+    """
+
+    def __init__(self, tamanho_fila=100, max_assinantes=MAX_ASSINANTES):
+        self.tamanho_fila = tamanho_fila
+        self.max_assinantes = max_assinantes
+        self._assinantes = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def assinar(self):
+        """Retorna a fila do novo painel, ou None se o processo já está no limite"""
+        fila = queue.Queue(maxsize=self.tamanho_fila)
+        with self._lock:
+            if len(self._assinantes) >= self.max_assinantes:
+                return None
+            self._assinantes.add(fila)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._escutar, name='listen-fiado', daemon=True)
+                self._thread.start()
+        return fila
+
+    def cancelar(self, fila):
+        with self._lock:
+            self._assinantes.discard(fila)
+
+    def publicar(self, evento):
+        with self._lock:
+            assinantes = list(self._assinantes)
+        for fila in assinantes:
+            try:
+                fila.put_nowait(evento)
+            except queue.Full:
+                # Cliente lento demais: descarta a fila e pede para recarregar a página
+                self.cancelar(fila)
+                with fila.mutex:
+                    fila.queue.clear()
+                fila.put_nowait({"tabela": None, "recarregar": True})
+
+    def _escutar(self):
+        while True:
+            conn = None
+            try:
+                conn = db.get_connection()
+                conn.autocommit = True
+                conn.cursor().execute(f"LISTEN {CANAL}")
+
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    while conn.notifies:
+                        notificacao = conn.notifies.pop(0)
+                        evento = montar_delta(json.loads(notificacao.payload))
+                        if evento:
+                            self.publicar(evento)
+            except Exception as e:
+                print(f"Erro no LISTEN de mudanças: {e}")
+                # Eventos podem ter sido perdidos durante a queda: painéis recalculam tudo
+                self.publicar({"tabela": None, "recarregar": True})
+                time.sleep(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+transmissor = Transmissor()
+
+
+def formatar_sse(evento):
+    return f"data: {json.dumps(evento)}\n\n"
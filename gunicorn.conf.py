@@ -0,0 +1,15 @@
+# Configuração do gunicorn (lida automaticamente ao rodar "gunicorn" nesta pasta).
+# create_app() não abre conexão com o banco, então o app pode ser carregado uma vez
+# no processo mestre (preload) e os workers sobem já prontos, só com fork.
+import os
+
+wsgi_app = "app:app"
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+
+preload_app = os.getenv("GUNICORN_PRELOAD", "1") == "1"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+
+# Threads: cada painel conectado em /eventos (SSE) ocupa uma thread enquanto está aberto.
+# SSE_MAX_POR_PROCESSO (padrão 4) limita quantas delas o SSE pode pegar por worker.
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "8"))
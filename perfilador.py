@@ -0,0 +1,136 @@
+import linecache
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+# Onde ficam as capturas (.folded = formato "collapsed stacks", abre direto no speedscope.app)
+PERFIS_DIR = os.getenv("PERFIS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "perfis"))
+INTERVALO_MS = float(os.getenv("PERFIL_INTERVALO_MS", "5"))
+
+CATEGORIAS = ('db', 'template', 'python')
+
+# Linhas que, no topo da pilha, indicam que o processo está esperando o PostgreSQL
+_CHAMADAS_DB = ('.execute(', '.fetchone(', '.fetchall(', '.commit(', 'get_connection(', 'psycopg2.connect(')
+
+
+def _eh_template(frame):
+    arquivo = frame.f_code.co_filename
+    return arquivo.endswith('.html') or f'{os.sep}jinja2{os.sep}' in arquivo
+
+
+def _eh_db(frame):
+    arquivo = frame.f_code.co_filename
+    if f'{os.sep}psycopg2{os.sep}' in arquivo:
+        return True
+    # Chamadas em C do psycopg2 não geram frame: olhamos a linha Python que as chamou
+    linha = linecache.getline(arquivo, frame.f_lineno)
+    return any(chamada in linha for chamada in _CHAMADAS_DB)
+
+
+def classificar(pilha):
+    """Atribui a amostra a DB, template (Jinja) ou Python puro"""
+    if _eh_db(pilha[-1]):
+        return 'db'
+    if any(_eh_template(frame) for frame in pilha):
+        return 'template'
+    return 'python'
+
+
+def _nome_frame(frame):
+    codigo = frame.f_code
+    nome = f"{os.path.basename(codigo.co_filename)}:{codigo.co_name}"
+    return nome.replace(';', '_').replace(' ', '_')
+
+
+class Amostrador:
+    """Profiler estatístico: uma thread lê a pilha da thread da requisição a cada N ms.
+
+    Nada é instrumentado dentro do código da aplicação, então o custo fica restrito
+    às requisições que pediram o perfil.
+    """
+
+    def __init__(self, thread_id=None, intervalo_ms=INTERVALO_MS):
+        self.thread_id = thread_id or threading.get_ident()
+        self.intervalo = intervalo_ms / 1000.0
+        self.pilhas = Counter()
+        self.por_categoria = Counter()
+        self.duracao = 0.0
+        self._parar = threading.Event()
+        self._thread = threading.Thread(target=self._rodar, name='perfilador', daemon=True)
+
+    def iniciar(self):
+        self._inicio = time.perf_counter()
+        self._thread.start()
+        return self
+
+    def parar(self):
+        if self._parar.is_set():
+            return self
+        self._parar.set()
+        self._thread.join()
+        self.duracao = time.perf_counter() - self._inicio
+        return self
+
+    def _rodar(self):
+        while not self._parar.wait(self.intervalo):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            pilha = []
+            while frame is not None:
+                pilha.append(frame)
+                frame = frame.f_back
+            pilha.reverse()
+
+            categoria = classificar(pilha)
+            self.pilhas[';'.join([categoria] + [_nome_frame(f) for f in pilha])] += 1
+            self.por_categoria[categoria] += 1
+
+    def tempos_ms(self):
+        """Divide a duração da requisição entre as categorias, proporcional às amostras"""
+        total = sum(self.por_categoria.values())
+        if not total:
+            return {categoria: 0.0 for categoria in CATEGORIAS}
+        return {categoria: self.duracao * 1000 * self.por_categoria[categoria] / total for categoria in CATEGORIAS}
+
+    def server_timing(self):
+        return ', '.join(f"{categoria};dur={ms:.1f}" for categoria, ms in self.tempos_ms().items())
+
+
+def nome_rota(regra):
+    """'/cliente/<int:cliente_id>' -> 'cliente_int_cliente_id'"""
+    return re.sub(r'[^A-Za-z0-9]+', '_', regra or 'sem_rota').strip('_') or 'raiz'
+
+
+def salvar_captura(amostrador, regra):
+    os.makedirs(PERFIS_DIR, exist_ok=True)
+    nome = f"{nome_rota(regra)}__{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.folded"
+    with open(os.path.join(PERFIS_DIR, nome), 'w', encoding='utf-8') as arquivo:
+        for pilha, contagem in amostrador.pilhas.most_common():
+            arquivo.write(f"{pilha} {contagem}\n")
+    return nome
+
+
+def listar_capturas(rota=None):
+    if not os.path.isdir(PERFIS_DIR):
+        return []
+    nomes = sorted(n for n in os.listdir(PERFIS_DIR) if n.endswith('.folded'))
+    if rota:
+        nomes = [n for n in nomes if n.split('__')[0] == nome_rota(rota)]
+    return nomes
+
+
+def agregar_capturas(rota=None):
+    """Soma as pilhas de todas as capturas (opcionalmente de uma rota só)"""
+    pilhas = Counter()
+    for nome in listar_capturas(rota):
+        with open(os.path.join(PERFIS_DIR, nome), encoding='utf-8') as arquivo:
+            for linha in arquivo:
+                pilha, _, contagem = linha.rstrip('\n').rpartition(' ')
+                if pilha and contagem.isdigit():
+                    pilhas[pilha] += int(contagem)
+    return pilhas
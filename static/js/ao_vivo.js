@@ -0,0 +1,77 @@
+// Atualizações ao vivo via Server-Sent Events (/eventos).
+// Cada evento traz um delta ("fiado +12.50 do cliente 7") que é somado direto na tela,
+// sem recarregar a página nem refazer os totais no servidor.
+(function () {
+    if (!window.EventSource) return;
+
+    // Se o servidor recusar (503, limite de conexões ao vivo), tenta de novo depois
+    const ESPERA_RECONEXAO_MS = 60000;
+    let fonte = null;
+    let jaConectou = false;
+
+    function formatar(valor) {
+        return 'R$ ' + valor.toFixed(2);
+    }
+
+    // Elementos com data-total="fiado_hoje|recebido_hoje|total_rua"
+    function somarTotal(nome, delta) {
+        document.querySelectorAll('[data-total="' + nome + '"]').forEach(function (el) {
+            const valor = parseFloat(el.dataset.valor || '0') + delta;
+            el.dataset.valor = valor;
+            el.textContent = formatar(valor);
+        });
+    }
+
+    // Elementos com data-divida-cliente="<id>"; o texto fica em .valor-ao-vivo
+    function somarCliente(clienteId, delta) {
+        if (!clienteId) return;
+        document.querySelectorAll('[data-divida-cliente="' + clienteId + '"]').forEach(function (el) {
+            const anterior = parseFloat(el.dataset.valor || '0');
+            const valor = anterior + delta;
+            if ((anterior > 0) !== (valor > 0)) {
+                // Mudou de "Em dia" para "Devendo" (ou o contrário): layout diferente
+                location.reload();
+                return;
+            }
+            el.dataset.valor = valor;
+            const alvo = el.querySelector('.valor-ao-vivo') || el;
+            alvo.textContent = formatar(valor);
+        });
+    }
+
+    function conectar() {
+        fonte = new EventSource('/eventos');
+        fonte.onopen = function () {
+            // Reconexão: os eventos do intervalo se perderam, então recalcula tudo uma vez
+            if (jaConectou) location.reload();
+            jaConectou = true;
+        };
+        fonte.onerror = function () {
+            // Erros de rede o próprio EventSource reconecta; resposta != 200 fecha de vez
+            if (fonte.readyState === EventSource.CLOSED) {
+                setTimeout(conectar, ESPERA_RECONEXAO_MS);
+            }
+        };
+        fonte.onmessage = receber;
+    }
+
+    function receber(msg) {
+        const ev = JSON.parse(msg.data);
+        if (ev.recarregar) {
+            fonte.close();
+            location.reload();
+            return;
+        }
+        if (ev.tabela === 'fiados') {
+            somarTotal('total_rua', ev.delta);
+            if (ev.hoje) somarTotal('fiado_hoje', ev.delta);
+            somarCliente(ev.cliente_id, ev.delta);
+        } else if (ev.tabela === 'pagamentos') {
+            somarTotal('total_rua', -ev.delta);
+            if (ev.hoje) somarTotal('recebido_hoje', ev.delta);
+            somarCliente(ev.cliente_id, -ev.delta);
+        }
+    }
+
+    conectar();
+})();
@@ -0,0 +1,228 @@
+// Fila offline do balcão: fiados e pagamentos vão para o localStorage com uma chave
+// de idempotência e são enviados em lote para /api/sync (uma única transação no servidor).
+(function () {
+    const CHAVE_FILA = 'fiado_fila';
+    const CHAVE_FALHAS = 'fiado_falhas';
+    const CHAVE_CURSOR = 'fiado_cursor';
+    const CHAVE_CLIENTES = 'fiado_clientes';
+
+    if ('serviceWorker' in navigator) {
+        navigator.serviceWorker.register('/sw.js');
+    }
+
+    function lerLista(chave) {
+        try {
+            return JSON.parse(localStorage.getItem(chave) || '[]');
+        } catch (e) {
+            return [];
+        }
+    }
+
+    function lerFila() {
+        return lerLista(CHAVE_FILA);
+    }
+
+    function lerCursor() {
+        // Cursor antigo (texto com ids) ou corrompido: volta a null e o servidor manda tudo
+        try {
+            const cursor = JSON.parse(localStorage.getItem(CHAVE_CURSOR) || 'null');
+            return cursor && typeof cursor === 'object' ? cursor : null;
+        } catch (e) {
+            return null;
+        }
+    }
+
+    function gravarFila(fila) {
+        localStorage.setItem(CHAVE_FILA, JSON.stringify(fila));
+        atualizarAviso();
+    }
+
+    function novaChave() {
+        if (window.crypto && crypto.randomUUID) return crypto.randomUUID();
+        return Date.now() + '-' + Math.random().toString(16).slice(2);
+    }
+
+    function atualizarAviso() {
+        const pendentes = lerFila().length;
+        const falhas = lerLista(CHAVE_FALHAS);
+        if (falhas.length) {
+            const ultima = falhas[falhas.length - 1];
+            mostrarAviso(falhas.length + ' lançamento(s) recusado(s) pelo servidor: ' + ultima.erro +
+                         ' (R$ ' + (ultima.dados.valor || '?') + ')', true);
+        } else {
+            mostrarAviso(pendentes ? pendentes + ' lançamento(s) aguardando conexão' : '');
+        }
+    }
+
+    function mostrarAviso(texto, erro) {
+        let aviso = document.getElementById('aviso-fila');
+        if (!aviso) {
+            aviso = document.createElement('div');
+            aviso.id = 'aviso-fila';
+            aviso.className = 'fixed top-16 left-0 w-full text-center text-sm font-bold p-2 z-50';
+            aviso.title = 'Toque para dispensar os lançamentos recusados';
+            aviso.addEventListener('click', function () {
+                if (lerLista(CHAVE_FALHAS).length && confirm('Descartar os lançamentos recusados?')) {
+                    localStorage.removeItem(CHAVE_FALHAS);
+                    atualizarAviso();
+                }
+            });
+            document.body.appendChild(aviso);
+        }
+        aviso.textContent = texto;
+        aviso.style.display = texto ? 'block' : 'none';
+        aviso.classList.toggle('bg-red-500', !!erro);
+        aviso.classList.toggle('bg-yellow-300', !erro);
+        aviso.classList.toggle('text-white', !!erro);
+    }
+
+    function lerClientes() {
+        try {
+            return JSON.parse(localStorage.getItem(CHAVE_CLIENTES) || '{}') || {};
+        } catch (e) {
+            return {};
+        }
+    }
+
+    // Guarda os clientes que mudaram desde o cursor; é o que as páginas em cache usam offline
+    function guardarDeltas(corpo) {
+        // Sem cursor anterior o servidor mandou todos: começa do zero
+        const clientes = lerCursor() ? lerClientes() : {};
+        (corpo.clientes || []).forEach(function (cliente) {
+            clientes[cliente.id] = { nome: cliente.nome, divida: cliente.divida_total };
+        });
+        (corpo.removidos || []).forEach(function (id) {
+            delete clientes[id];
+        });
+        localStorage.setItem(CHAVE_CLIENTES, JSON.stringify(clientes));
+        aplicarClientes(clientes, corpo.removidos || []);
+    }
+
+    // Atualiza saldos (data-divida-cliente) e a lista de clientes do /fiado/registrar
+    function aplicarClientes(clientes, removidos) {
+        Object.keys(clientes).forEach(function (id) {
+            document.querySelectorAll('[data-divida-cliente="' + id + '"]').forEach(function (el) {
+                el.dataset.valor = clientes[id].divida;
+                const alvo = el.querySelector('.valor-ao-vivo') || el;
+                alvo.textContent = 'R$ ' + Number(clientes[id].divida).toFixed(2);
+            });
+        });
+
+        const lista = document.getElementById('clientList');
+        if (!lista) return;
+        removidos.forEach(function (id) {
+            const radio = lista.querySelector('input[name="cliente_id"][value="' + id + '"]');
+            if (radio) radio.closest('label').remove();
+        });
+        Object.keys(clientes).forEach(function (id) {
+            if (lista.querySelector('input[name="cliente_id"][value="' + id + '"]')) return;
+            const label = document.createElement('label');
+            label.className = 'flex items-center p-3 border-b border-gray-100 hover:bg-blue-50 cursor-pointer client-item';
+            const radio = document.createElement('input');
+            radio.type = 'radio';
+            radio.name = 'cliente_id';
+            radio.value = id;
+            radio.required = true;
+            radio.className = 'w-5 h-5 text-blue-600';
+            const nome = document.createElement('span');
+            nome.className = 'ml-3 font-medium text-gray-700 name-text';
+            nome.textContent = clientes[id].nome;
+            label.appendChild(radio);
+            label.appendChild(nome);
+            lista.appendChild(label);
+        });
+    }
+
+    // Tira da fila a operação recusada e guarda na lista de falhas (visível), para o resto subir
+    function moverParaFalhas(chave, erro) {
+        const fila = lerFila();
+        const op = fila.find(function (item) { return item.chave === chave; });
+        if (!op) return false;
+        const falhas = lerLista(CHAVE_FALHAS);
+        falhas.push(Object.assign({}, op, { erro: erro }));
+        localStorage.setItem(CHAVE_FALHAS, JSON.stringify(falhas));
+        gravarFila(fila.filter(function (item) { return item.chave !== chave; }));
+        return true;
+    }
+
+    function enviarLote() {
+        // Fila vazia também sincroniza: é assim que os deltas chegam às páginas em cache
+        const fila = lerFila();
+
+        return fetch('/api/sync', {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ operacoes: fila, cursor: lerCursor() }),
+        }).then(function (resp) {
+            if (resp.status === 400) {
+                return resp.json().then(function (corpo) {
+                    if (corpo.chave && moverParaFalhas(corpo.chave, corpo.erro)) {
+                        return enviarLote();  // o lote inteiro foi desfeito: reenvia o que sobrou
+                    }
+                    mostrarAviso('Erro ao sincronizar: ' + corpo.erro, true);
+                    return false;
+                });
+            }
+            if (!resp.ok || resp.redirected) return false;  // sem conexão / sessão expirada
+            return resp.json().then(function (corpo) {
+                // Remove só o que foi enviado: novos itens podem ter entrado durante o envio
+                const enviadas = new Set(fila.map(function (op) { return op.chave; }));
+                gravarFila(lerFila().filter(function (op) { return !enviadas.has(op.chave); }));
+                guardarDeltas(corpo);
+                localStorage.setItem(CHAVE_CURSOR, JSON.stringify(corpo.cursor));
+                return true;
+            });
+        }).catch(function () {
+            return false;
+        });
+    }
+
+    let envioEmAndamento = null;
+
+    function enviarFila() {
+        if (envioEmAndamento) return envioEmAndamento;
+        // Web Locks: duas abas não enviam a mesma fila ao mesmo tempo
+        const envio = navigator.locks
+            ? navigator.locks.request('fiado_fila', enviarLote)
+            : enviarLote();
+        envioEmAndamento = envio.finally(function () {
+            envioEmAndamento = null;
+        });
+        return envioEmAndamento;
+    }
+
+    // Formulários marcados com data-offline="fiado|pagamento"
+    document.querySelectorAll('form[data-offline]').forEach(function (form) {
+        form.addEventListener('submit', function (evento) {
+            evento.preventDefault();
+            const dados = Object.fromEntries(new FormData(form).entries());
+            if (form.dataset.clienteId) dados.cliente_id = form.dataset.clienteId;
+            // Hora do lançamento no balcão, não a do envio
+            dados.registrado_em = new Date().toISOString();
+
+            const fila = lerFila();
+            fila.push({ chave: novaChave(), tipo: form.dataset.offline, dados: dados });
+            gravarFila(fila);
+
+            enviarFila().then(function (enviado) {
+                if (enviado) {
+                    window.location.href = '/cliente/' + dados.cliente_id;
+                } else {
+                    form.reset();
+                }
+            });
+        });
+    });
+
+    window.addEventListener('online', enviarFila);
+    setInterval(function () {
+        if (lerFila().length) enviarFila();
+    }, 30000);
+    atualizarAviso();
+    if (!navigator.onLine) {
+        // Página veio do cache do service worker: usa os saldos do último sync
+        aplicarClientes(lerClientes(), []);
+    }
+    enviarFila();
+})();
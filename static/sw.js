@@ -0,0 +1,69 @@
+// Service worker do balcão: mantém as telas de venda e de cliente disponíveis sem internet.
+// Os lançamentos feitos offline ficam na fila de static/js/fila_offline.js.
+const CACHE = 'fiado-balcao-v2';
+const PRE_CACHE = [
+    '/fiado/registrar',
+    '/static/js/fila_offline.js',
+    '/static/js/ao_vivo.js',
+];
+const PAGINAS_OFFLINE = [/^\/fiado\/registrar$/, /^\/cliente\/\d+$/];
+
+self.addEventListener('install', function (evento) {
+    evento.waitUntil(
+        caches.open(CACHE).then(function (cache) {
+            // Falha silenciosa se ainda não estiver logado: a página entra no cache na próxima visita
+            return Promise.all(PRE_CACHE.map(function (url) { return cache.add(url).catch(function () {}); }));
+        }).then(function () { return self.skipWaiting(); })
+    );
+});
+
+self.addEventListener('activate', function (evento) {
+    evento.waitUntil(
+        caches.keys().then(function (nomes) {
+            return Promise.all(nomes.filter(function (n) { return n !== CACHE; }).map(function (n) { return caches.delete(n); }));
+        }).then(function () { return self.clients.claim(); })
+    );
+});
+
+self.addEventListener('fetch', function (evento) {
+    const req = evento.request;
+    if (req.method !== 'GET') return;
+    const url = new URL(req.url);
+    if (url.origin !== location.origin) return;
+
+    if (url.pathname.startsWith('/static/')) {
+        // Estáticos: stale-while-revalidate. Responde do cache na hora e atualiza em
+        // segundo plano, então um deploy novo chega no aparelho na visita seguinte.
+        evento.respondWith(
+            caches.open(CACHE).then(function (cache) {
+                return cache.match(req).then(function (cacheado) {
+                    const daRede = fetch(req).then(function (resp) {
+                        if (resp.ok) cache.put(req, resp.clone());
+                        return resp;
+                    });
+                    if (cacheado) {
+                        evento.waitUntil(daRede.catch(function () {}));
+                        return cacheado;
+                    }
+                    return daRede;
+                });
+            })
+        );
+        return;
+    }
+
+    if (PAGINAS_OFFLINE.some(function (padrao) { return padrao.test(url.pathname); })) {
+        // Telas do balcão: rede primeiro (dados frescos), cache se a conexão cair
+        evento.respondWith(
+            fetch(req).then(function (resp) {
+                if (resp.ok && !resp.redirected) {
+                    const copia = resp.clone();
+                    caches.open(CACHE).then(function (cache) { cache.put(url.pathname, copia); });
+                }
+                return resp;
+            }).catch(function () {
+                return caches.match(url.pathname);
+            })
+        );
+    }
+});